@@ -11,14 +11,17 @@ fillers immediately when a tool call is detected.
 """
 
 import asyncio
+import atexit
+import functools
 import logging
+import logging.handlers
 import os
+import queue
 import time
-from datetime import datetime
-from typing import Dict, Any, List
+from types import MappingProxyType
+from typing import Dict, Any, Final, List, Tuple
 
 from dotenv import load_dotenv
-from livekit import rtc
 from livekit.agents import (
     AutoSubscribe,
     JobContext,
@@ -34,109 +37,178 @@ from livekit.plugins import deepgram, openai, elevenlabs, silero
 
 load_dotenv()
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
+
+def _log_level_from_env() -> int:
+    """Parse LOG_LEVEL (a level name like "WARNING" or a number like "30"), default INFO."""
+    raw = os.getenv("LOG_LEVEL", "INFO").strip()
+    if raw.isdigit():
+        return int(raw)
+    level = logging.getLevelName(raw.upper())
+    if isinstance(level, int):
+        return level
+    # Logging isn't configured yet, so this goes through logging.lastResort to stderr
+    logging.getLogger("voice-agent").warning("Unknown LOG_LEVEL %r, using INFO", raw)
+    return logging.INFO
+
+
+# Configure logging. LOG_LEVEL applies to this agent's own logger, which the SDK's
+# cli.run_app/--log-level never resets and which job processes inherit, so e.g.
+# LOG_LEVEL=WARNING silences the per-event [METRICS]/[USER]/[STATE] logs in production.
+_LOG_LEVEL = _log_level_from_env()
+
 logger = logging.getLogger("voice-agent")
+logger.setLevel(_LOG_LEVEL)
+
+# Optional queue-based log pipeline: records are queued and written to stderr by a
+# listener thread so event callbacks never block on I/O. It is installed lazily from
+# prewarm/entrypoint, not at import: agent.py is always imported before the SDK adds its
+# own root handlers (cli.run_app's setup_logging in the worker, the IPC log handler in
+# job processes). Under cli.run_app those handlers are present by the time prewarm or
+# entrypoint runs, so the pipeline is skipped and output isn't duplicated. It only takes
+# effect when nothing else configured logging.
+_log_listener = None
+
+
+def _install_log_pipeline():
+    """Route root logging through a QueueListener if no handlers are configured yet."""
+    global _log_listener
+    root = logging.getLogger()
+    if _log_listener is not None or root.handlers:
+        return
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+    _log_listener = logging.handlers.QueueListener(
+        log_queue, stream_handler, respect_handler_level=True
+    )
+    root.setLevel(_LOG_LEVEL)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    _log_listener.start()
+    # Covers normal interpreter exit; job processes exit via os._exit, so
+    # entrypoint also calls _flush_logs() before returning.
+    atexit.register(_log_listener.stop)
+
+
+def _flush_logs():
+    """Write out queued records. Blocking; run via asyncio.to_thread."""
+    if _log_listener is None:
+        return
+    # stop() drains the queue and joins the thread; restart for later jobs in this process
+    _log_listener.stop()
+    _log_listener.start()
 
 # ============================================
 # METRICS TRACKING
 # ============================================
 
+# Approximate pricing used for cost estimates
+# GPT-4o: $5/1M input, $15/1M output
+_LLM_IN_COST: Final = 5e-6
+_LLM_OUT_COST: Final = 15e-6
+# Deepgram: $0.0125/minute
+_STT_COST_PER_SEC: Final = 0.0125 / 60.0
+# ElevenLabs: ~$0.30/1K chars
+_TTS_COST_PER_CHAR: Final = 0.30 / 1000.0
+
+
 class MetricsCollector:
     """Collects and aggregates metrics for a session."""
     
     def __init__(self, job_id: str, room_id: str):
         self.job_id = job_id
         self.room_id = room_id
-        self.session_start = time.time()
+        # Monotonic: only used for durations and transcript offsets
+        self.session_start = time.monotonic()
         
         # LLM metrics
-        self.total_llm_tokens = 0
         self.total_input_tokens = 0
         self.total_output_tokens = 0
-        self.llm_ttft_list: List[float] = []
+        self._ttft_n = 0
+        self._ttft_sum = 0.0
         
         # TTS metrics
         self.total_tts_characters = 0
-        self.tts_ttfb_list: List[float] = []
+        self._ttfb_n = 0
+        self._ttfb_sum = 0.0
         
         # STT metrics
         self.total_stt_duration = 0.0
         
         # EOU metrics
-        self.eou_list: List[float] = []
+        self._eou_n = 0
+        self._eou_sum = 0.0
         
         # Turn tracking
         self.turn_count = 0
         self.total_requests = 0
         
-        # Transcript
-        self.transcript: List[Dict[str, str]] = []
+        # Transcript: (role, text, seconds since session start)
+        self.transcript: List[Tuple[str, str, float]] = []
+        # Pre-formatted "role: text" lines so get_summary only has to join
+        self._transcript_lines: List[str] = []
     
     def add_llm_metrics(self, metrics_event):
         """Process LLM metrics event."""
-        if hasattr(metrics_event, 'completion_tokens'):
-            self.total_output_tokens += metrics_event.completion_tokens or 0
-        if hasattr(metrics_event, 'prompt_tokens'):
-            self.total_input_tokens += metrics_event.prompt_tokens or 0
-        if hasattr(metrics_event, 'ttft') and metrics_event.ttft:
-            self.llm_ttft_list.append(metrics_event.ttft)
-        
-        self.total_llm_tokens = self.total_input_tokens + self.total_output_tokens
+        completion_tokens = getattr(metrics_event, 'completion_tokens', None) or 0
+        prompt_tokens = getattr(metrics_event, 'prompt_tokens', None) or 0
+        ttft = getattr(metrics_event, 'ttft', None)
+        self.total_output_tokens += completion_tokens
+        self.total_input_tokens += prompt_tokens
+        if ttft:
+            self._ttft_n += 1
+            self._ttft_sum += ttft
         self.total_requests += 1
-        logger.info(f"[METRICS] LLM: +{metrics_event.completion_tokens or 0} output tokens, TTFT={metrics_event.ttft}s")
+        logger.info("[METRICS] LLM: +%s output tokens, TTFT=%ss", completion_tokens, ttft)
     
     def add_tts_metrics(self, metrics_event):
         """Process TTS metrics event."""
-        if hasattr(metrics_event, 'characters_count'):
-            self.total_tts_characters += metrics_event.characters_count or 0
-        if hasattr(metrics_event, 'ttfb') and metrics_event.ttfb:
-            self.tts_ttfb_list.append(metrics_event.ttfb)
-        logger.info(f"[METRICS] TTS: +{metrics_event.characters_count or 0} chars, TTFB={metrics_event.ttfb}s")
+        characters_count = getattr(metrics_event, 'characters_count', None) or 0
+        ttfb = getattr(metrics_event, 'ttfb', None)
+        self.total_tts_characters += characters_count
+        if ttfb:
+            self._ttfb_n += 1
+            self._ttfb_sum += ttfb
+        logger.info("[METRICS] TTS: +%s chars, TTFB=%ss", characters_count, ttfb)
     
     def add_stt_metrics(self, metrics_event):
         """Process STT metrics event."""
-        if hasattr(metrics_event, 'audio_duration'):
-            self.total_stt_duration += metrics_event.audio_duration or 0.0
-        logger.info(f"[METRICS] STT: +{metrics_event.audio_duration}s audio")
+        audio_duration = getattr(metrics_event, 'audio_duration', None)
+        self.total_stt_duration += audio_duration or 0.0
+        logger.info("[METRICS] STT: +%ss audio", audio_duration)
     
     def add_eou_metrics(self, metrics_event):
         """Process End of Utterance metrics."""
-        if hasattr(metrics_event, 'end_of_utterance_delay') and metrics_event.end_of_utterance_delay:
-            self.eou_list.append(metrics_event.end_of_utterance_delay)
-        logger.info(f"[METRICS] EOU: {metrics_event.end_of_utterance_delay}s")
+        eou_delay = getattr(metrics_event, 'end_of_utterance_delay', None)
+        if eou_delay:
+            self._eou_n += 1
+            self._eou_sum += eou_delay
+        logger.info("[METRICS] EOU: %ss", eou_delay)
     
     def add_transcript(self, role: str, text: str):
         """Add to transcript."""
-        self.transcript.append({
-            "role": role,
-            "text": text,
-            "timestamp": datetime.now().isoformat()
-        })
+        self.transcript.append((role, text, time.monotonic() - self.session_start))
+        self._transcript_lines.append(f"{role}: {text}")
         if role == "assistant":
             self.turn_count += 1
     
     def get_summary(self, shutdown_reason: str = "normal") -> Dict[str, Any]:
         """Generate final session summary."""
-        session_duration = time.time() - self.session_start
+        session_duration = time.monotonic() - self.session_start
         
-        # Calculate averages
-        avg_ttft = sum(self.llm_ttft_list) / len(self.llm_ttft_list) if self.llm_ttft_list else 0
-        avg_ttfb = sum(self.tts_ttfb_list) / len(self.tts_ttfb_list) if self.tts_ttfb_list else 0
-        avg_eou = sum(self.eou_list) / len(self.eou_list) if self.eou_list else 0
+        # Calculate averages (running count/sum, no per-sample storage)
+        avg_ttft = self._ttft_sum / self._ttft_n if self._ttft_n else 0
+        avg_ttfb = self._ttfb_sum / self._ttfb_n if self._ttfb_n else 0
+        avg_eou = self._eou_sum / self._eou_n if self._eou_n else 0
         
         # Calculate costs (approximate)
-        # GPT-4o: $5/1M input, $15/1M output
-        llm_cost = (self.total_input_tokens * 0.000005) + (self.total_output_tokens * 0.000015)
-        # Deepgram: $0.0125/minute
-        stt_cost = (self.total_stt_duration / 60) * 0.0125
-        # ElevenLabs: ~$0.30/1K chars
-        tts_cost = (self.total_tts_characters / 1000) * 0.30
+        llm_cost = self.total_input_tokens * _LLM_IN_COST + self.total_output_tokens * _LLM_OUT_COST
+        stt_cost = self.total_stt_duration * _STT_COST_PER_SEC
+        tts_cost = self.total_tts_characters * _TTS_COST_PER_CHAR
         
         return {
             "job_id": self.job_id,
             "room_id": self.room_id,
-            "total_llm_tokens": self.total_llm_tokens,
+            "total_llm_tokens": self.total_input_tokens + self.total_output_tokens,
             "total_input_tokens": self.total_input_tokens,
             "total_output_tokens": self.total_output_tokens,
             "total_tts_characters": self.total_tts_characters,
@@ -152,21 +224,88 @@ class MetricsCollector:
             "turn_count": self.turn_count,
             "session_duration": session_duration,
             "shutdown_reason": shutdown_reason,
-            "transcript": "\n".join([f"{t['role']}: {t['text']}" for t in self.transcript])
+            "transcript": "\n".join(self._transcript_lines)
         }
 
 
+def _log_summary(summary: Dict[str, Any]):
+    """Log the session summary. Blocking; run via asyncio.to_thread."""
+    logger.info("=" * 50)
+    logger.info("[SESSION SUMMARY]")
+    logger.info(f"  Duration: {summary['session_duration']:.1f}s")
+    logger.info(f"  Turns: {summary['turn_count']}")
+    logger.info(f"  LLM Tokens: {summary['total_llm_tokens']} (in: {summary['total_input_tokens']}, out: {summary['total_output_tokens']})")
+    logger.info(f"  TTS Characters: {summary['total_tts_characters']}")
+    logger.info(f"  STT Duration: {summary['total_stt_audio_duration']:.1f}s")
+    logger.info(f"  Avg TTFT: {summary['avg_ttft']:.3f}s")
+    logger.info(f"  Avg TTFB: {summary['avg_ttfb']:.3f}s")
+    logger.info(f"  Avg EOU: {summary['avg_eou']:.3f}s")
+    logger.info(f"  Estimated Cost: ${summary['total_cost']:.4f}")
+    logger.info("=" * 50)
+    
+    # TODO: Save to Supabase here (runs in a worker thread, so a sync client is fine)
+    # save_to_supabase(summary)
+
+
 # ============================================
 # AGENT SETUP
 # ============================================
 
+# TTS preset matrix for internal testing.
+# Controlled via participant attribute `tts_preset` (set by the Playground).
+_TTS_PRESETS: Final = MappingProxyType({
+    # Safe default: good balance of latency and naturalness.
+    "balanced": MappingProxyType(dict(
+        model="eleven_flash_v2_5",
+        streaming_latency=3,
+        chunk_length_schedule=(80, 120),
+        min_sentence_len=5,
+        stream_context_len=5,
+    )),
+    # Prioritize making filler clearly separate from tool result.
+    "fast_sep": MappingProxyType(dict(
+        model="eleven_flash_v2_5",
+        streaming_latency=4,
+        chunk_length_schedule=(50,),
+        min_sentence_len=1,
+        stream_context_len=1,
+    )),
+    # Minimize buffering (lowest latency, may sound less natural).
+    "ultra_low_latency": MappingProxyType(dict(
+        model="eleven_flash_v2_5",
+        streaming_latency=0,
+        chunk_length_schedule=(50,),
+        min_sentence_len=1,
+        stream_context_len=1,
+    )),
+    # More natural pacing, more buffering.
+    "natural": MappingProxyType(dict(
+        model="eleven_flash_v2_5",
+        streaming_latency=3,
+        chunk_length_schedule=(120, 200, 260),
+        min_sentence_len=10,
+        stream_context_len=10,
+    )),
+})
+
+# Shared by all presets
+_VOICE_SETTINGS: Final = elevenlabs.VoiceSettings(
+    stability=0.5,
+    similarity_boost=0.75,
+)
+
+
 def prewarm(proc: JobProcess):
     """Preload models for faster startup."""
+    _install_log_pipeline()
     proc.userdata["vad"] = silero.VAD.load()
+    # SentenceTokenizer per (min_sentence_len, stream_context_len), shared across jobs
+    proc.userdata["tokenizer_cache"] = {}
 
 
 async def entrypoint(ctx: JobContext):
     """Main agent entrypoint."""
+    _install_log_pipeline()
     logger.info(f"[AGENT] Starting for room: {ctx.room.name}")
     
     # Initialize metrics collector
@@ -200,67 +339,36 @@ async def entrypoint(ctx: JobContext):
     )
     
     def build_tts(preset: str) -> elevenlabs.TTS:
-        """
-        Preset matrix for internal testing.
-        Controlled via participant attribute `tts_preset` (set by the Playground).
-        """
-        presets = {
-            # Safe default: good balance of latency and naturalness.
-            "balanced": dict(
-                model="eleven_flash_v2_5",
-                streaming_latency=3,
-                chunk_length_schedule=[80, 120],
-                min_sentence_len=5,
-                stream_context_len=5,
-            ),
-            # Prioritize making filler clearly separate from tool result.
-            "fast_sep": dict(
-                model="eleven_flash_v2_5",
-                streaming_latency=4,
-                chunk_length_schedule=[50],
-                min_sentence_len=1,
-                stream_context_len=1,
-            ),
-            # Minimize buffering (lowest latency, may sound less natural).
-            "ultra_low_latency": dict(
-                model="eleven_flash_v2_5",
-                streaming_latency=0,
-                chunk_length_schedule=[50],
-                min_sentence_len=1,
-                stream_context_len=1,
-            ),
-            # More natural pacing, more buffering.
-            "natural": dict(
-                model="eleven_flash_v2_5",
-                streaming_latency=3,
-                chunk_length_schedule=[120, 200, 260],
-                min_sentence_len=10,
-                stream_context_len=10,
-            ),
-        }
-
-        cfg = presets.get(preset, presets["balanced"])
-        tokenizer = tokenize.blingfire.SentenceTokenizer(
-            min_sentence_len=cfg["min_sentence_len"],
-            stream_context_len=cfg["stream_context_len"],
-        )
+        """Build ElevenLabs TTS for a preset name (see `_TTS_PRESETS`)."""
+        cfg = _TTS_PRESETS.get(preset, _TTS_PRESETS["balanced"])
+        tokenizer_cache = ctx.proc.userdata.setdefault("tokenizer_cache", {})
+        key = (cfg["min_sentence_len"], cfg["stream_context_len"])
+        tokenizer = tokenizer_cache.get(key)
+        if tokenizer is None:
+            tokenizer = tokenize.blingfire.SentenceTokenizer(
+                min_sentence_len=cfg["min_sentence_len"],
+                stream_context_len=cfg["stream_context_len"],
+            )
+            tokenizer_cache[key] = tokenizer
 
         return elevenlabs.TTS(
             model=cfg["model"],
-            voice_settings=elevenlabs.VoiceSettings(
-                stability=0.5,
-                similarity_boost=0.75,
-            ),
+            voice_settings=_VOICE_SETTINGS,
             auto_mode=True,
             word_tokenizer=tokenizer,
-            chunk_length_schedule=cfg["chunk_length_schedule"],
+            # Fresh list per TTS so option updates can't leak into the shared preset
+            chunk_length_schedule=list(cfg["chunk_length_schedule"]),
             streaming_latency=cfg["streaming_latency"],
         )
 
     tts = build_tts(tts_preset)
     
-    # VAD - Silero
-    vad = ctx.proc.userdata.get("vad") or silero.VAD.load()
+    # VAD - Silero (loaded once per process in prewarm)
+    vad = ctx.proc.userdata.get("vad")
+    if vad is None:
+        logger.error("[VAD] Not prewarmed, loading now")
+        vad = silero.VAD.load()
+        ctx.proc.userdata["vad"] = vad
     
     # Create the agent
     agent = Agent(
@@ -303,18 +411,20 @@ Keep your responses concise and friendly. Don't repeat information that was just
     @session.on("user_input_transcribed")
     def on_user_input(event):
         """Log user speech."""
-        if hasattr(event, 'transcript') and event.transcript:
-            metrics_collector.add_transcript("user", event.transcript)
-            logger.info(f"[USER] {event.transcript}")
+        transcript = getattr(event, 'transcript', None)
+        if transcript:
+            metrics_collector.add_transcript("user", transcript)
+            logger.info("[USER] %s", transcript)
     
     @session.on("agent_state_changed")
     def on_agent_state(event):
         """Track agent state changes."""
         # livekit.agents.voice.events.AgentStateChangedEvent uses old_state/new_state
-        try:
-            logger.info(f"[STATE] Agent state: {event.old_state} -> {event.new_state}")
-        except Exception:
-            logger.info(f"[STATE] Agent state changed: {event}")
+        old_state = getattr(event, 'old_state', None)
+        if old_state is not None:
+            logger.info("[STATE] Agent state: %s -> %s", old_state, getattr(event, 'new_state', None))
+        else:
+            logger.info("[STATE] Agent state changed: %s", event)
     
     # ============================================
     # START SESSION
@@ -340,40 +450,39 @@ Keep your responses concise and friendly. Don't repeat information that was just
         # Get final summary
         summary = metrics_collector.get_summary(shutdown_reason="participant_left")
         
-        # Log summary
-        logger.info("=" * 50)
-        logger.info("[SESSION SUMMARY]")
-        logger.info(f"  Duration: {summary['session_duration']:.1f}s")
-        logger.info(f"  Turns: {summary['turn_count']}")
-        logger.info(f"  LLM Tokens: {summary['total_llm_tokens']} (in: {summary['total_input_tokens']}, out: {summary['total_output_tokens']})")
-        logger.info(f"  TTS Characters: {summary['total_tts_characters']}")
-        logger.info(f"  STT Duration: {summary['total_stt_audio_duration']:.1f}s")
-        logger.info(f"  Avg TTFT: {summary['avg_ttft']:.3f}s")
-        logger.info(f"  Avg TTFB: {summary['avg_ttfb']:.3f}s")
-        logger.info(f"  Avg EOU: {summary['avg_eou']:.3f}s")
-        logger.info(f"  Estimated Cost: ${summary['total_cost']:.4f}")
-        logger.info("=" * 50)
-        
-        # TODO: Save to Supabase here
-        # await save_to_supabase(summary)
+        # Run off the event loop: under cli.run_app records go through the SDK's
+        # handlers (the queue pipeline is skipped), and the Supabase save will block
+        await asyncio.to_thread(_log_summary, summary)
     
     # Wait for disconnect
-    disconnect_event = asyncio.Event()
-
-    @ctx.room.on("participant_disconnected")
-    def on_participant_left(participant: rtc.RemoteParticipant):
-        logger.info(f"[AGENT] Participant left: {participant.identity}")
-        asyncio.create_task(shutdown())
-        disconnect_event.set()
-
-    @ctx.room.on("disconnected")
-    def on_room_disconnected(reason):
-        logger.info(f"[AGENT] Room disconnected: {reason}")
-        disconnect_event.set()
+    disconnected = asyncio.get_running_loop().create_future()
+    # Strong refs so the shutdown task can't be garbage-collected mid-run
+    pending_tasks: set = set()
+
+    def on_room_event(kind: str, arg):
+        """Single handler for participant-left and room-disconnected events."""
+        if kind == "participant_left":
+            logger.info("[AGENT] Participant left: %s", arg.identity)
+            if not disconnected.done():
+                task = asyncio.ensure_future(shutdown())
+                pending_tasks.add(task)
+                task.add_done_callback(pending_tasks.discard)
+                disconnected.set_result(None)
+        elif kind == "room_disconnected":
+            logger.info("[AGENT] Room disconnected: %s", arg)
+            if not disconnected.done():
+                disconnected.set_result(None)
+
+    ctx.room.on("participant_disconnected", functools.partial(on_room_event, "participant_left"))
+    ctx.room.on("disconnected", functools.partial(on_room_event, "room_disconnected"))
     
     # Keep agent running (AgentSession doesn't expose `wait()` in this SDK version)
-    await disconnect_event.wait()
-
+    await disconnected
+    # Let shutdown finish before the job returns
+    if pending_tasks:
+        await asyncio.gather(*pending_tasks)
+    # Make sure the session summary is written before the job process exits
+    await asyncio.to_thread(_flush_logs)
 
 # ============================================
 # MAIN